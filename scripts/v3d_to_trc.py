@@ -1,32 +1,55 @@
 # %%
+import argparse
+import locale
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
-def read_raw_v3d_export_file(filepath:str) -> pd.DataFrame:
+WRITE_BUFFER_SIZE = 1 << 20  # bytes
+HEADER_ENCODING = locale.getpreferredencoding(False)  # same codec text-mode open() uses
+CHUNK_FRAMES = 50_000  # frames converted per block when writing a TRC file
+HEADER_READ_SIZE = 1 << 16  # bytes read at a time when parsing a V3D export header
+HEADER_PATTERN = re.compile(r'^(?P<Origin>.+)\.c3d_(?P<Marker>.+)_(?P<Coordinate>[^_]+)$')
+
+def read_v3d_header(f) -> tuple[list[str], int]:
     """
-    Reads a Visual3D export file in TSV format and converts it to a simple pandas DataFrame
-    with flat column headers in the format MarkerName_Coordinate.
+    Parses the five header rows of a Visual3D export file.
     
     Parameters:
     -----------
-    filepath : str
-        Path to the Visual3D export file (.tsv)
+    f : binary file object
+        Visual3D export file (.tsv) opened in 'rb' mode and positioned at the start.
+        It is left positioned at the first data row.
     
     Returns:
     --------
-    pandas.DataFrame
-        DataFrame with columns named as MarkerName_Coordinate (e.g., LASIS_X)
-        and frame numbers as the index.
+    tuple[list[str], int]
+        Column headings in the format FileName_MarkerName_Coordinate, preceded by "ITEM",
+        and the byte offset of the first data row.
     """
-    # Read the first few lines to determine the header structure
-    with open(filepath, 'r') as f:
-        header_lines = [f.readline().strip() for _ in range(5)]
+    # Read the first few lines to determine the header structure. The header is
+    # pulled in with as few large reads as possible and split, instead of line by line.
+    start = f.tell()
+    header = f.read(HEADER_READ_SIZE)
+    while header.count(b"\n") < 5:
+        more = f.read(HEADER_READ_SIZE)
+        if not more:
+            break
+        header += more
+    raw_lines = header.split(b"\n", 5)[:5]
+    # V3D writes the header in the system code page (cp1252 on Windows), which is what
+    # text-mode open() used to decode it with. Undecodable bytes in the file paths
+    # become U+FFFD rather than aborting the parse.
+    header_lines = [line.decode(HEADER_ENCODING, errors="replace").strip() for line in raw_lines]
     
     # Extract marker names from the second line (index 1)
     filename_headers = [file for file in header_lines[0].split('\t')]
-    files = list(set(filename_headers)) 
 
     marker_names = [name for name in header_lines[1].split('\t') if name]
     axes = [axis for axis in header_lines[4].split('\t') if axis !="ITEM"] 
@@ -35,8 +58,45 @@ def read_raw_v3d_export_file(filepath:str) -> pd.DataFrame:
     column_headings = [f"{filename}_{marker}_{axis}" for filename, marker, axis in zip(filename_headers, marker_names, axes)]
     column_headings.insert(0,"ITEM")
 
-    # Read the data, skipping the header rows
-    df = pd.read_csv(filepath, sep='\t', skiprows=5, names=column_headings)
+    # Leave the file at the first data row
+    data_offset = start + sum(len(line) + 1 for line in raw_lines)
+    f.seek(data_offset)
+
+    return column_headings, data_offset
+
+def read_raw_v3d_export_file(filepath:str) -> pd.DataFrame:
+    """
+    Reads a Visual3D export file in TSV format and converts it to a simple pandas DataFrame
+    with flat column headers in the format MarkerName_Coordinate.
+    
+    Parameters:
+    -----------
+    filepath : str
+        Path to the Visual3D export file (.tsv)
+    
+    Returns:
+    --------
+    pandas.DataFrame
+        DataFrame with columns named as MarkerName_Coordinate (e.g., LASIS_X)
+        and frame numbers as the index.
+    """
+    with open(filepath, 'rb') as f:
+        column_headings, _ = read_v3d_header(f)
+
+        # Explicit types let the parser skip type inference. Coordinates are in meters
+        # and written out in mm to 6 decimals, so they keep full float64 precision.
+        column_types = {heading: pa.float64() for heading in column_headings}
+        column_types["ITEM"] = pa.int32()
+
+        # Read the data from the same handle, which is now positioned past the header rows.
+        # Arrow's CSV reader parses in parallel; convert to pandas only once parsing is done.
+        table = pacsv.read_csv(
+            f,
+            read_options=pacsv.ReadOptions(column_names=column_headings),
+            parse_options=pacsv.ParseOptions(delimiter='\t'),
+            convert_options=pacsv.ConvertOptions(column_types=column_types),
+        )
+    df = table.to_pandas()
     
     # Rename the first column to 'Frame' and set it as index
     df.rename(columns={'ITEM': 'Frame'}, inplace=True)
@@ -45,39 +105,33 @@ def read_raw_v3d_export_file(filepath:str) -> pd.DataFrame:
     return df
 
 def split_by_file_origin(raw_dataframe:pd.DataFrame)->pd.DataFrame:
-    landmarks = raw_dataframe.reset_index()
-    landmarks_long = pd.melt(landmarks,
-                            id_vars=["Frame"],
-                            var_name='Header',     # Name for the new column holding original column names
-                            value_name='Value'       # Name for the new column holding the values
-                            )
-    # df_split = landmarks_long.copy()
-
-    new_column_names = ['Origin', 'Marker_Coordinate']
-
-    # Use .str.rsplit() to split from the right side.
-    # n=2 means make at most 2 splits from the right.
-    # expand=True tells pandas to return a DataFrame with separate columns.
-    split_data = landmarks_long['Header'].str.rsplit('.c3d_', n=2, expand=True)
-    # Assign these new columns back to the DataFrame
-    landmarks_long[new_column_names] = split_data
-
-    # Need to go back and clean up the combined Marker_Coordinate now that it's simpler to split
-    new_column_names = ['Marker', 'Coordinate']
-    split_data = landmarks_long['Marker_Coordinate'].str.rsplit('_',n=1, expand=True)
-    landmarks_long[new_column_names] = split_data
-
-    # Optional: Drop the original 'Header' column as it's now redundant
-    landmarks_long = landmarks_long.drop(['Header', 'Marker_Coordinate'], axis=1)
-
-    # Reorder columns for clarity
-    landmarks_long = landmarks_long[['Frame', 'Origin', 'Marker', 'Coordinate', 'Value']]
-    landmarks_long = landmarks_long.set_index("Frame")
-    return landmarks_long
+    """
+    Labels the columns of a raw Visual3D export by origin file, marker and coordinate.
+    The data stays wide; only the column names are parsed.
+    
+    Parameters:
+    -----------
+    raw_dataframe : pandas.DataFrame
+        DataFrame from read_raw_v3d_export_file, with columns named
+        FileName.c3d_MarkerName_Coordinate
+    
+    Returns:
+    --------
+    pandas.DataFrame
+        The same data with MultiIndex columns (Origin, Marker, Coordinate) and
+        frame numbers as the index. For the long format with one row per value, use
+        .melt(value_name='Value', ignore_index=False).
+    """
+    # Split each header into its parts once per column rather than once per value:
+    # everything before the last '.c3d_' is the origin file, and the text
+    # after the final '_' is the coordinate
+    split_columns = [HEADER_PATTERN.match(col).groups() for col in raw_dataframe.columns]
+    columns = pd.MultiIndex.from_tuples(split_columns, names=['Origin', 'Marker', 'Coordinate'])
+    return raw_dataframe.set_axis(columns, axis=1)
 
 def get_all_v3d_trajectories(tsv_folder:Path, subject:str)->pd.DataFrame:
-    landmarks = read_raw_v3d_export_file(Path(data_dir,f"{subject_id}_landmarks.tsv"))
-    targets = read_raw_v3d_export_file(Path(data_dir,f"{subject_id}_targets.tsv"))
+    landmarks = read_raw_v3d_export_file(Path(tsv_folder,f"{subject}_landmarks.tsv"))
+    targets = read_raw_v3d_export_file(Path(tsv_folder,f"{subject}_targets.tsv"))
 
     print("Landmarks and Targets imported")
 
@@ -86,6 +140,24 @@ def get_all_v3d_trajectories(tsv_folder:Path, subject:str)->pd.DataFrame:
 
     return trajectories
 
+def _gather_marker_block(trajectories_df, positions, start, stop):
+    """
+    Return frames start:stop of the columns at `positions` as a new float64 array.
+    A position of -1 marks a column that is not in the DataFrame and comes back as NaN.
+    """
+    values = trajectories_df.iloc[start:stop].to_numpy(dtype=np.float64)
+    block = values[:, positions]
+    block[:, positions < 0] = np.nan
+    return block
+
+def _format_trc_rows(rows, row_format):
+    """
+    Format a 2D array of TRC rows (frame, time, coordinates...) as text.
+    The row format is repeated for every row so the whole block is rendered
+    by a single %-formatting call instead of one call per row.
+    """
+    return (row_format * len(rows)) % tuple(rows.ravel().tolist())
+
 def convert_df_to_trc(trajectories_df, output_filepath, frame_rate=100, units='mm'):
     """
     Convert Visual3D exported trajectories to OpenSim TRC format.
@@ -101,96 +173,193 @@ def convert_df_to_trc(trajectories_df, output_filepath, frame_rate=100, units='m
     units : str
         Units for the TRC file ('mm' or 'm')
     """
-    # Make a copy of the dataframe
-    df = trajectories_df.copy()
-    
-    # Handle NaN values with interpolation
-    if df.isna().any().any():
-        df = df.interpolate(method='linear', limit_direction='both')
-        print("NaN values interpolated")
-    
-    # Convert units from meters to millimeters
-    df = df * 1000.0
-    
-    # Extract unique marker names
-    markers = []
-    for col in df.columns:
+    # Extract unique marker names, in order of first appearance.
+    # A dict gives constant-time membership checks while deduplicating.
+    markers = {}
+    for col in trajectories_df.columns:
         # Check if the column ends with _X, _Y, or _Z
-        if col.endswith('_X') or col.endswith('_Y') or col.endswith('_Z'):
+        if col.endswith(('_X', '_Y', '_Z')):
             # Get everything except the last 2 characters
-            marker = col[:-2]
-            if marker not in markers:
-                markers.append(marker)
-                
-                
+            markers[col[:-2]] = None
+    markers = list(markers)
+
     num_markers = len(markers)
-    num_frames = len(df)
-    start_frame = df.index[0]
-    
-    # Create time column based on frame rate
-    time_column = [frame / frame_rate for frame in df.index]
-    
-    # Write the TRC file
-    with open(output_filepath, 'w') as f:
-        # Write header
-        f.write(f"PathFileType\t4\t(X/Y/Z)\t{output_filepath}\n")
-        f.write(f"DataRate\tCameraRate\tNumFrames\tNumMarkers\tUnits\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames\n")
-        f.write(f"{frame_rate}\t{frame_rate}\t{num_frames}\t{num_markers}\t{units}\t{frame_rate}\t{start_frame}\t{num_frames}\n")
+    num_frames = len(trajectories_df)
+    start_frame = trajectories_df.index[0]
+    
+    col_order = [f"{marker}_{axis}" for marker in markers for axis in ("X", "Y", "Z")]
+
+    # Look up the position of each marker's X, Y and Z column once, so chunks are
+    # gathered by integer indexing rather than label lookups
+    col_index = {col: i for i, col in enumerate(trajectories_df.columns)}
+    positions = np.array([col_index.get(col, -1) for col in col_order], dtype=np.intp)
+
+    # Find the marker columns that have gaps and those with no data at all,
+    # in a single pass over the frames, one chunk at a time
+    has_nan = np.zeros(len(col_order), dtype=bool)
+    has_data = np.zeros(len(col_order), dtype=bool)
+    for start in range(0, num_frames, CHUNK_FRAMES):
+        block = _gather_marker_block(trajectories_df, positions, start, start + CHUNK_FRAMES)
+        nan_block = np.isnan(block)
+        has_nan |= nan_block.any(axis=0)
+        has_data |= ~nan_block.all(axis=0)
+
+    empty_cols = [col_order[c] for c in np.flatnonzero(~has_data)]
+    if empty_cols:
+        print(f"No data to interpolate for: {', '.join(empty_cols)}")
+
+    # Handle NaN values with linear interpolation. Only the columns that have gaps
+    # are held in memory in full; they are patched into each chunk as it is written.
+    filled_columns = {}
+    for c in np.flatnonzero(has_nan & has_data):
+        values = trajectories_df[col_order[c]].to_numpy(dtype=np.float64, copy=True)
+        missing = np.isnan(values)
+        present = ~missing
+        values[missing] = np.interp(np.flatnonzero(missing), np.flatnonzero(present), values[present])
+        filled_columns[c] = values
+    if filled_columns:
+        print("NaN values interpolated")
+
+    # Create frame and time columns based on frame rate
+    frame_column = trajectories_df.index.to_numpy()
+    time_column = frame_column / frame_rate
+    
+    # Write the TRC file in binary mode so writes skip newline translation and encoding hooks.
+    # It is written to a temporary file next to the output and only moved into place once
+    # complete, so an interrupted run never leaves a truncated TRC file behind.
+    temp_filepath = f"{output_filepath}.{os.getpid()}.tmp"
+    try:
+        with open(temp_filepath, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            # Write header
+            header = [
+                f"PathFileType\t4\t(X/Y/Z)\t{output_filepath}\n",
+                f"DataRate\tCameraRate\tNumFrames\tNumMarkers\tUnits\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames\n",
+                f"{frame_rate}\t{frame_rate}\t{num_frames}\t{num_markers}\t{units}\t{frame_rate}\t{start_frame}\t{num_frames}\n",
+            ]
         
-        # Write column headers - first row
-        header1 = "Frame#\tTime\t"
-        for marker in markers:
-            header1 += f"{marker}\t\t\t"
-        f.write(header1.rstrip() + "\n")
+            # Column headers - first row
+            header1 = ["Frame#", "Time"] + [f"{marker}\t\t" for marker in markers]
+            header.append("\t".join(header1).rstrip() + "\n")
         
-        # Write coordinate labels - second row
-        header2 = "\t\t"
-        for i in range(1, num_markers+1):
-            header2 += f"X{i}\tY{i}\tZ{i}\t"
-        f.write(header2.rstrip() + "\n")
+            # Coordinate labels - second row
+            header2 = ["", ""] + [f"X{i}\tY{i}\tZ{i}" for i in range(1, num_markers+1)]
+            header.append("\t".join(header2).rstrip() + "\n")
+            f.write("".join(header).encode(HEADER_ENCODING, errors="replace"))
         
-        # Write data
-        for i, frame in enumerate(df.index):
-            line = f"{frame}\t{time_column[i]:.6f}\t"
-            
-            for marker in markers:
-                # Get X, Y, Z values
-                x_val = df.loc[frame, f"{marker}_X"]
-                y_val = df.loc[frame, f"{marker}_Y"]
-                z_val = df.loc[frame, f"{marker}_Z"]
-                
+            # Write data in chunks of frames so only one chunk is converted at a time.
+            # Rows are formatted and written in blocks of roughly WRITE_BUFFER_SIZE characters.
+            row_format = "\t".join(['%d', '%.6f'] + ['%.6f'] * (3 * num_markers)) + "\n"
+            rows_per_write = max(1, WRITE_BUFFER_SIZE // (12 * (2 + 3 * num_markers)))
+            out_buffer = np.empty((min(CHUNK_FRAMES, num_frames), 2 + 3 * num_markers))
+            for start in range(0, num_frames, CHUNK_FRAMES):
+                stop = min(start + CHUNK_FRAMES, num_frames)
+                block = _gather_marker_block(trajectories_df, positions, start, stop)
+                for c, values in filled_columns.items():
+                    block[:, c] = values[start:stop]
+
+                # Convert units from meters to millimeters
+                block *= 1000.0
+
                 # Apply coordinate transformation from Visual3D to OpenSim
                 # OpenSim: Y-up, Z-forward, X-right
                 # Assuming Visual3D is: Z-up, X-forward, Y-right
-                transformed_x = x_val  # Keep X as is
-                transformed_y = z_val  # OpenSim Y = Visual3D Z
-                transformed_z = -y_val # OpenSim Z = -Visual3D Y
-                
-                line += f"{transformed_x:.6f}\t{transformed_y:.6f}\t{transformed_z:.6f}\t"
-            
-            f.write(line.rstrip() + "\n")
+                v3d_block = block.reshape(stop - start, num_markers, 3)
+                out = out_buffer[:stop - start]
+                out[:, 0] = frame_column[start:stop]
+                out[:, 1] = time_column[start:stop]
+                out[:, 2::3] = v3d_block[..., 0]                  # Keep X as is
+                out[:, 3::3] = v3d_block[..., 2]                  # OpenSim Y = Visual3D Z
+                np.negative(v3d_block[..., 1], out=out[:, 4::3])  # OpenSim Z = -Visual3D Y
+
+                for row_start in range(0, stop - start, rows_per_write):
+                    f.write(_format_trc_rows(out[row_start:row_start + rows_per_write], row_format).encode('ascii'))
+        os.replace(temp_filepath, output_filepath)
+    except BaseException:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
     
     print(f"TRC file created: {output_filepath}")
     print(f"- Frames: {num_frames}")
     print(f"- Markers: {num_markers}")
     return None
     
-# if __name__ == "__main__":
-if True:
+def process_subject(subject_id:str, data_dir:Path, output_dir:Path, force:bool=False)->Path:
+    """
+    Converts one subject's Visual3D landmark and target exports into a single TRC file.
+    The conversion is skipped when the TRC file is already newer than both exports.
     
-    subject_id = "s1"
-    data_dir = r"C:\Users\Mac Prible\OneDrive - The University of Texas at Austin\research\OpenSimCourse\project\v3d_output"
-    # output_dir = r"C:\Users\Mac Prible\OneDrive - The University of Texas at Austin\research\OpenSimCourse\project\s1\trc"
-    output_dir = r"C:\Users\Mac Prible\repos\pdsv_opensim\output"
-    output_path = Path(output_dir,f"{subject_id}_walking.trc")
+    Parameters:
+    -----------
+    subject_id : str
+        Subject identifier used in the file names (e.g., s1)
+    data_dir : str or Path
+        Folder holding {subject_id}_landmarks.tsv and {subject_id}_targets.tsv
+    output_dir : str or Path
+        Folder where {subject_id}_walking.trc is written
+    force : bool
+        Rebuild the TRC file even if it is up to date
     
+    Returns:
+    --------
+    Path
+        Path to the TRC file
+    """
+    landmarks_file = Path(data_dir, f"{subject_id}_landmarks.tsv")
+    targets_file = Path(data_dir, f"{subject_id}_targets.tsv")
+    output_path = Path(output_dir, f"{subject_id}_walking.trc")
+
+    source_mtime = max(os.path.getmtime(landmarks_file), os.path.getmtime(targets_file))
+    if not force and output_path.exists() and os.path.getmtime(output_path) >= source_mtime:
+        print(f"TRC file up to date, skipping: {output_path}")
+        return output_path
+
+    trajectories = get_all_v3d_trajectories(Path(data_dir), subject_id)
+    convert_df_to_trc(trajectories, output_path)
+    return output_path
 
+def process_all(subject_ids:list[str], data_dir:Path, output_dir:Path, workers:int|None=None, force:bool=False)->list[Path]:
+    """
+    Runs process_subject for several subjects in parallel, one subject per worker process.
+    
+    Parameters:
+    -----------
+    subject_ids : list of str
+        Subject identifiers used in the file names (e.g., ["s1", "s2"])
+    data_dir : str or Path
+        Folder holding the Visual3D exports for all subjects
+    output_dir : str or Path
+        Folder where the TRC files are written
+    workers : int or None
+        Number of worker processes; defaults to the CPU count.
+        Keep this low (e.g., 2) when the data is on a spinning disk.
+    force : bool
+        Rebuild TRC files even if they are up to date
     
-    # trajectories = get_all_v3d_trajectories(Path(data_dir), subject_id)
-    # convert_df_to_trc(trajectories,output_path)
-    # print(trajectories.head)
+    Returns:
+    --------
+    list of Path
+        Paths to the TRC files, in the same order as subject_ids
+    """
+    convert = partial(process_subject, data_dir=data_dir, output_dir=output_dir, force=force)
 
-# %
-# %%
-landmarks = read_raw_v3d_export_file(Path(data_dir,f"{subject_id}_landmarks.tsv"))
-landmarks_by_origin = split_by_file_origin(landmarks)
+    # No need for a process pool when there is only one subject or one worker
+    if len(subject_ids) <= 1 or workers == 1:
+        return [convert(subject_id) for subject_id in subject_ids]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(convert, subject_ids))
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert Visual3D trajectory exports to OpenSim TRC files.")
+    parser.add_argument("subject_ids", nargs="*", default=["s1"], help="subject identifiers used in the export file names")
+    parser.add_argument("--data-dir", default=r"C:\Users\Mac Prible\OneDrive - The University of Texas at Austin\research\OpenSimCourse\project\v3d_output")
+    parser.add_argument("--output-dir", default=r"C:\Users\Mac Prible\repos\pdsv_opensim\output")
+    parser.add_argument("--force", action="store_true", help="rebuild the TRC file even if it is newer than the exports")
+    parser.add_argument("--workers", type=int, default=None, help="number of subjects to convert in parallel (default: CPU count)")
+    args = parser.parse_args()
+
+    process_all(args.subject_ids, Path(args.data_dir), Path(args.output_dir), workers=args.workers, force=args.force)
+
+if __name__ == "__main__":
+    main()